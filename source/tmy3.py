@@ -1,10 +1,38 @@
 """GridLAB-D TMY3 Reader"""
 import os, sys
 import json
-import pandas
+import errno
+import email.utils
+import csv
+import pickle
+import tempfile
+import concurrent.futures
+import functools
+import types
+import contextlib
+import mmap
 import datetime
+import numpy
+import pandas
 import requests
 
+try:
+    import pyarrow, pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import polars
+except ImportError:
+    polars = None
+
+if polars and pyarrow:
+    CSV_ENGINE = "polars" # multithreaded CSV parser with projection pushdown
+elif pyarrow:
+    CSV_ENGINE = "pyarrow" # multithreaded CSV parser
+else:
+    CSV_ENGINE = "c" # set CSV_ENGINE to "c" or "pyarrow" to use the pandas parsers
+
 config_dir = f"{os.getenv('HOME')}/.gridlabd-weather"
 cache_dir = f"{config_dir}/data"
 
@@ -19,28 +47,28 @@ def load_config(pathname=f"{config_dir}/config.json"):
 
         (dict)            Configuration data loaded
     """
-    with open(filename,"rt") as f:
+    with open(pathname,"rt") as f:
         global config
         config = json.load(f)
     return config
 
-def save_config(filename=f"{config_dir}/config.json"):
+def save_config(pathname=f"{config_dir}/config.json"):
     """Save TMY3 configuration
 
     PARAMETERS:
 
-        pathname (str)    Pathname of the configuration file to load
+        pathname (str)    Pathname of the configuration file to save
 
     RETURNS:
 
         None
     """
-    with open(filename,"wt") as f:
+    with open(pathname,"wt") as f:
         json.dump(config,f,indent=4)
 
-try:
+if os.path.exists(f"{config_dir}/config.json"):
     load_config()
-except:
+else:
     config = dict(
         server = "https://github.com/",
         organization = "slacgismo",
@@ -49,11 +77,146 @@ except:
         country = "US",
         index_name = ".index",
         )
+    os.makedirs(config_dir,exist_ok=True)
     save_config()
 
 if not os.path.exists(cache_dir):
     os.makedirs(cache_dir,exist_ok=True)
 
+_POOL_MAXSIZE = 16 # keep-alive connections per host, also the default number of download threads
+_SESSION = requests.Session() # keep-alive connections shared by all downloads
+_SESSION.mount("https://",requests.adapters.HTTPAdapter(pool_connections=4,pool_maxsize=_POOL_MAXSIZE))
+
+FLOAT_COLUMNS = [
+    'ETR (W/m^2)', 'ETRN (W/m^2)',
+    'GHI (W/m^2)', 'GHI uncert (%)',
+    'DNI (W/m^2)', 'DNI uncert (%)',
+    'DHI (W/m^2)', 'DHI uncert (%)',
+    'GH illum (lx)', 'Global illum uncert (%)',
+    'DN illum (lx)', 'DN illum uncert (%)',
+    'DH illum (lx)', 'DH illum uncert (%)',
+    'Zenith lum (cd/m^2)', 'Zenith lum uncert (%)',
+    'TotCld (tenths)', 'OpqCld (tenths)',
+    'Dry-bulb (C)', 'Dew-point (C)', 'RHum (%)', 'Pressure (mbar)',
+    'Wdir (degrees)', 'Wspd (m/s)', 'Hvis (m)', 'CeilHgt (m)',
+    'Pwat (cm)', 'AOD (unitless)', 'Alb (unitless)',
+    'Lprecip depth (mm)', 'Lprecip quantity (hr)',
+    ]
+
+SOURCE_COLUMNS = [
+    'GHI source', 'DNI source', 'DHI source',
+    'GH illum source', 'DN illum source', 'DH illum source', 'Zenith lum source',
+    'TotCld source', 'OpqCld source',
+    'Dry-bulb source', 'Dew-point source', 'RHum source', 'Pressure source',
+    'Wdir source', 'Wspd source', 'Hvis source', 'CeilHgt source',
+    'Pwat source', 'AOD source', 'Alb source',
+    'Lprecip source', 'PresWth source',
+    ]
+
+UNCERT_COLUMNS = [
+    'TotCld uncert (code)', 'OpqCld uncert (code)',
+    'Dry-bulb uncert (code)', 'Dew-point uncert (code)', 'RHum uncert (code)', 'Pressure uncert (code)',
+    'Wdir uncert (code)', 'Wspd uncert (code)', 'Hvis uncert (code)', 'CeilHgt uncert (code)',
+    'Pwat uncert (code)', 'AOD uncert (code)', 'Alb uncert (code)',
+    'Lprecip uncert (code)', 'PresWth uncert (code)',
+    ]
+
+DTYPES = {'Date (MM/DD/YYYY)' : 'str', 'Time (HH:MM)' : 'str'} \
+    | {column : 'float32' for column in FLOAT_COLUMNS} \
+    | {column : 'category' for column in SOURCE_COLUMNS} \
+    | {column : 'int8' for column in UNCERT_COLUMNS} \
+    | {'PresWth (METAR code)' : 'int16'}
+
+PYARROW_DTYPES = DTYPES | {column : 'str' for column in SOURCE_COLUMNS}
+
+PARQUET_VERSION = b"1" # change whenever the columns or dtypes written to parquet snapshots change
+
+if polars:
+    POLARS_DTYPES = {column : {
+            'str' : polars.String,
+            'float32' : polars.Float32,
+            'int8' : polars.Int8,
+            'int16' : polars.Int16,
+            'category' : polars.Categorical,
+            }[dtype] for column, dtype in DTYPES.items()}
+
+RENAME_MAP = {
+    'DateTime' : 'datetime',
+    'Date (MM/DD/YYYY)' : "date",
+    'Time (HH:MM)' : "hour",
+    'ETR (W/m^2)' : "etr", 
+    'ETRN (W/m^2)' : "etrn",
+    'GHI (W/m^2)' : "ghi", 
+    'DNI (W/m^2)' : "dni",
+    'DHI (W/m^2)' : "dhi",
+    'GH illum (lx)' : "ghillum",
+    'DN illum (lx)' : "dnillum",
+    'DH illum (lx)' : "dhillum",
+    'Zenith lum (cd/m^2)' : "zenlu",
+    'TotCld (tenths)' : "totcld",
+    'OpqCld (tenths)' : "opqcld",
+    'Dry-bulb (C)' : "drybulb",
+    'Dew-point (C)' : "dewpoint",
+    'RHum (%)' : "rhum",
+    'Pressure (mbar)' : "pressure",
+    'Wdir (degrees)' : "wdir",
+    'Wspd (m/s)' : "wspd",
+    'Hvis (m)' : "hvis",
+    'CeilHgt (m)' : "ceilhgt",
+    'Pwat (cm)' : "pwat",
+    'AOD (unitless)' : "aod",
+    'Alb (unitless)' : "alb",
+    'Lprecip depth (mm)' : "lprecipdepth",
+    'Lprecip quantity (hr)' : "lprecipquantity",
+}
+
+INFO_COLUMNS = {
+    "station" : int,
+    "name" : str,
+    "state" : str,
+    "tzoffset" : float,
+    "latitude" : float,
+    "longitude" : float,
+    "elevation" : float,
+}
+
+KEEP_COLUMNS = [column for column in RENAME_MAP if column in DTYPES]
+
+DATETIME_COLUMNS = ['Date (MM/DD/YYYY)','Time (HH:MM)'] # always read, DateTime is built from them
+
+QA_COLUMNS = [column for column in DTYPES if column not in KEEP_COLUMNS]
+
+ATTRIBUTES = {name : column for column, name in RENAME_MAP.items()}
+
+HOURS = numpy.array([datetime.time(hour=hour) for hour in range(24)],dtype=object)
+
+UNITS = types.MappingProxyType({ # read-only because it is shared by all TMY3 objects
+    'etr' : "W/m^2", 
+    'etrn' : "W/m^2",
+    'ghi' : "W/m^2", 
+    'dni' : "W/m^2",
+    'dhi' : "W/m^2",
+    'ghillum' : "lx",
+    'dhillum' : "lx",
+    'dnillum' : "lx",
+    'zenlu' : "cd/m^2",
+    'totcld' : "0.1unit",
+    'opqcld' : "0.1unit",
+    'drybulb' : "degC",
+    'dewpoint' : "degC",
+    'rhum' : "%",
+    'pressure' : "mbar",
+    'wdir' : "deg",
+    'wspd' : "m/s",
+    'hvis' : "m",
+    'ceilhgt' : "m",
+    'pwat' : "cm",
+    'aod' : "unit",
+    'alb' : "unit",
+    'lprecipdepth' : "mm",
+    'lprecipquantity' : "hr",
+})
+
 def get_index():
     """Get station index
 
@@ -61,9 +224,38 @@ def get_index():
 
         (list) List of station names sorted alphabetically
     """
-    return sorted(get_data(config['index_name']).strip().split('\n'))
+    return list(_get_index()) # a copy, so that callers cannot change the cached index
+
+@functools.lru_cache(maxsize=1)
+def _get_index():
+    index_file = get_data(config['index_name'],cache_filename_only=True)
+    pickle_file = f"{index_file}.pkl"
+    if os.path.exists(pickle_file) and os.path.getmtime(pickle_file) >= os.path.getmtime(index_file):
+        try:
+            with open(pickle_file,"rb") as f:
+                return pickle.load(f)
+        except (pickle.UnpicklingError,EOFError):
+            pass # damaged pickle, so rebuild it from the index file
+    with open(index_file,"rt") as f:
+        index = sorted(f.read().strip().split('\n'))
+    with _atomic_write(pickle_file) as f:
+        pickle.dump(index,f)
+    return index
+
+def invalidate_index():
+    """Discard the cached station index so that the next get_index() downloads it again
+
+    RETURNS:
+
+        None
+    """
+    _get_index.cache_clear()
+    index_file = f"{cache_dir}/{config['index_name']}"
+    for file in [index_file,f"{index_file}.pkl"]:
+        if os.path.exists(file):
+            os.remove(file)
 
-def get_tmy3(tmy3_name,coerce_year=None):
+def get_tmy3(tmy3_name,coerce_year=None,only=None,use_python_datetime=False,keep_qa=False):
     """Get station TMY3 data
 
     PARAMETERS:
@@ -72,16 +264,61 @@ def get_tmy3(tmy3_name,coerce_year=None):
 
         coerce_year (int)   Year to use when indexing dates (default is None, i.e., use TMY data year)
 
+        only (list)         Properties to load, e.g., ['drybulb','ghi'] (default is None, i.e., all properties)
+
+        use_python_datetime (bool)  Return dates and times as datetime objects instead of datetime64 (default is False)
+
+        keep_qa (bool)      Include the source and uncertainty columns in the dataframe (default is False)
+
     RETURNS:
 
-        (class TMY3)        TMY3 object
+        (class TMY3)        TMY3 object (shared by all calls with the same arguments)
     """
     filename = get_data(tmy3_name,cache_filename_only=True)
-    return TMY3(filename,coerce_year)
+    return _load_tmy3(filename,os.stat(filename).st_mtime_ns,coerce_year,tuple(only) if only else None,use_python_datetime,keep_qa)
+
+@functools.lru_cache(maxsize=128)
+def _load_tmy3(filename,mtime,coerce_year,only,use_python_datetime,keep_qa):
+    # mtime is only part of the key, so that a refreshed download is loaded again
+    return TMY3(filename,coerce_year,only,use_python_datetime,keep_qa)
+
+def get_tmy3_many(names,coerce_year=None,only=None,use_python_datetime=False,keep_qa=False,max_workers=None):
+    """Get TMY3 data for several stations in parallel
+
+    Files are downloaded concurrently on threads and parsed on separate processes,
+    so TMY3 objects are pickled back to the caller. Objects whose parquet cache
+    is already fresh carry no data and load their properties on first access.
+
+    PARAMETERS:
+
+        names (list)        Station names from station index; see get_index()
+
+        coerce_year (int)   Year to use when indexing dates (default is None, i.e., use TMY data year)
+
+        only (list)         Properties to load, e.g., ['drybulb','ghi'] (default is None, i.e., all properties)
+
+        use_python_datetime (bool)  Return dates and times as datetime objects instead of datetime64 (default is False)
+
+        keep_qa (bool)      Include the source and uncertainty columns in the dataframe (default is False)
+
+        max_workers (int)   Maximum number of concurrent downloads and of parsing processes (default is None, i.e., executor defaults)
+
+    RETURNS:
+
+        (list)              TMY3 objects in the same order as names
+    """
+    filenames = get_many(names,cache_filename_only=True,max_workers=max_workers)
+    load = functools.partial(TMY3,coerce_year=coerce_year,only=only,use_python_datetime=use_python_datetime,keep_qa=keep_qa)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(load,filenames))
 
 def get_data(filename,cache_filename_only=False):
     """Get raw TMY3 data file
 
+    Cached files are revalidated with the server using their ETag once per
+    process, and only downloaded again when they have changed. The cached copy
+    is used as is when the server cannot be reached or GLD_WEATHER_OFFLINE=1 is set.
+
     PARAMETERS:
 
         filename (str)               TMY3 data file to retrieve from 
@@ -93,26 +330,143 @@ def get_data(filename,cache_filename_only=False):
         (class TMY3) or (str)        TMY3 data or cache file name
     """
     cache_file = f"{cache_dir}/{filename}"
-    if os.path.exists(cache_file):
-        if cache_filename_only:
-            return cache_file
-        with open(cache_file,"rt") as f:
-            return f.read()    
+    if not os.path.exists(cache_file):
+        _download(filename,cache_file)
+        _revalidated.add(cache_file)
+    elif os.getenv("GLD_WEATHER_OFFLINE") != "1" and cache_file not in _revalidated:
+        _revalidated.add(cache_file)
+        try:
+            _download(filename,cache_file,revalidate=True)
+        except OSError: # includes requests.RequestException
+            pass # server unreachable or file withdrawn, so keep the cached copy
+    if cache_filename_only:
+        return cache_file
+    with open(cache_file,"rt") as f:
+        return f.read()
+
+_revalidated = set() # cache files already checked against the server by this process
+_umask = os.umask(0o022); os.umask(_umask) # read once at import, since os.umask() is process wide
+
+@contextlib.contextmanager
+def _atomic_write(target):
+    """Open a temporary binary file next to target, and move it into place only once it is completely written"""
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(target),prefix=f".{os.path.basename(target)}.")
+    try:
+        with open(fd,"wb") as f:
+            yield f
+        os.chmod(tmp_file,0o666&~_umask) # mkstemp() creates files readable only by the owner
+        os.replace(tmp_file,target)
+    except BaseException:
+        os.unlink(tmp_file)
+        raise
+
+def _download(filename,cache_file,revalidate=False):
+    """Download a file into the cache, unless revalidation shows the cached copy is current"""
     url = f"{config['server']}{config['organization']}/{config['repository']}/raw/{config['branch']}/{config['country']}/{filename}"
-    r = requests.get(url)
-    if r.status_code == 200:
-        with open(cache_file,"wt") as f:
-            f.write(r.text)
-        if cache_filename_only:
-            return cache_file
-        return r.text
+    etag_file = f"{cache_file}.etag"
+    headers = {}
+    if revalidate:
+        headers["If-Modified-Since"] = email.utils.formatdate(os.path.getmtime(cache_file),usegmt=True)
+        if os.path.exists(etag_file):
+            with open(etag_file,"rt") as f:
+                headers["If-None-Match"] = f.read().strip()
+    with _SESSION.get(url,headers=headers,stream=True,timeout=30) as r:
+        if revalidate and r.status_code == 304:
+            return
+        if r.status_code != 200:
+            raise OSError(2,"file not found",cache_file)
+        with _atomic_write(cache_file) as f: # never leave a partial download in the cache
+            for chunk in r.iter_content(64*1024): # decodes transfer compression and raises read errors as requests exceptions
+                f.write(chunk)
+        etag = r.headers.get("ETag")
+    if etag:
+        with open(etag_file,"wt") as f:
+            f.write(etag)
+    elif os.path.exists(etag_file):
+        os.remove(etag_file)
+
+def get_many(names,cache_filename_only=False,max_workers=None):
+    """Get several raw TMY3 data files concurrently
+
+    PARAMETERS:
+
+        names (list)                 TMY3 data files to retrieve, e.g., from get_index()
+
+        cache_filename_only (bool)   Return only the names of the cache files, not the data in the files
+
+        max_workers (int)            Maximum number of concurrent downloads (default None, i.e., ThreadPoolExecutor
+                                     default, but no more than the session's connection pool size)
+
+    RETURNS:
+
+        (list)                       TMY3 data or cache file names in the same order as names
+    """
+    if max_workers is None:
+        # more threads than pooled connections would open and drop extra connections
+        max_workers = min(_POOL_MAXSIZE,(os.cpu_count() or 1)+4)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(lambda name: get_data(name,cache_filename_only),names))
+
+@contextlib.contextmanager
+def _open_csv(filename):
+    """Open a TMY3 file, returning the station info fields and a handle positioned at the data header"""
+    with open(filename,"rb") as f:
+        if hasattr(os,"posix_fadvise"):
+            os.posix_fadvise(f.fileno(),0,0,os.POSIX_FADV_SEQUENTIAL)
+        if CSV_ENGINE == "c":
+            # the C parser tokenizes straight from the page cache, as with memory_map=True
+            with mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as fh:
+                yield next(csv.reader([fh.readline().decode()])), fh
+        else:
+            yield next(csv.reader([f.readline().decode()])), f
+
+def _read_csv(fh,columns=None):
+    """Read the TMY3 data rows that follow the station info line in fh, in the order of columns (default all, in file order)"""
+    if CSV_ENGINE == "polars":
+        data = polars.read_csv(fh,columns=columns,schema_overrides=POLARS_DTYPES,n_rows=8760).to_pandas()
+        # polars orders categories by first appearance, pandas sorts them
+        for column in data.columns.intersection(SOURCE_COLUMNS):
+            data[column] = data[column].cat.reorder_categories(sorted(data[column].cat.categories))
+    elif CSV_ENGINE == "pyarrow":
+        # pyarrow does not support nrows, and infers numeric categories unless the source columns are read as str
+        data = pandas.read_csv(fh,header=0,usecols=columns,dtype=PYARROW_DTYPES,engine='pyarrow').iloc[:8760]
+        for column in data.columns.intersection(SOURCE_COLUMNS):
+            data[column] = data[column].astype('category')
     else:
-        raise OSError(2,"file not found",cache_file)
+        data = pandas.read_csv(fh,header=0,nrows=8760,usecols=columns,dtype=DTYPES,engine='c')
+    if columns:
+        data = data[columns]
+    if 'Date (MM/DD/YYYY)' in data:
+        data['Date (MM/DD/YYYY)'] = pandas.to_datetime(data['Date (MM/DD/YYYY)'],format="%m/%d/%Y").astype('datetime64[ns]')
+    if 'Time (HH:MM)' in data:
+        hhmm = data['Time (HH:MM)'].to_numpy().astype('S5').view(numpy.int8).reshape(-1,5) # fixed-width HH:MM bytes
+        data['Time (HH:MM)'] = (hhmm[:,0]-ord('0'))*10 + (hhmm[:,1]-ord('0')) - 1
+    data.index.name = "Hour"
+    return data
+
+def _parquet_source(parquet):
+    """Get the CSV mtime (ns) a parquet snapshot was built from, or None if it has no current PARQUET_VERSION"""
+    metadata = pyarrow.parquet.read_schema(parquet).metadata or {} # reads only the file footer
+    if metadata.get(b"gridlabd-weather") != PARQUET_VERSION or b"gridlabd-weather-source" not in metadata:
+        return None
+    return int(metadata[b"gridlabd-weather-source"])
+
+def _write_parquet(data,parquet,source):
+    """Write a parquet snapshot tagged with PARQUET_VERSION and the source CSV mtime (ns), replacing any previous one atomically"""
+    table = pyarrow.Table.from_pandas(data)
+    table = table.replace_schema_metadata(table.schema.metadata | {
+        b"gridlabd-weather" : PARQUET_VERSION,
+        b"gridlabd-weather-source" : str(source).encode(),
+        })
+    with _atomic_write(parquet) as f: # readers never see a partly written snapshot
+        pyarrow.parquet.write_table(table,f,compression='zstd')
 
 class TMY3:
     """TMY3 container implementation
     """
-    def __init__(self,filename,coerce_year=None):
+    units = UNITS # class attribute so that instances stay picklable
+
+    def __init__(self,filename,coerce_year=None,only=None,use_python_datetime=False,keep_qa=False):
         """TMY3 object initialization
 
         PARAMETERS:
@@ -121,199 +475,299 @@ class TMY3:
 
             coerce_year      Year to use when setting dates (default None, i.e., use TMY3 years)
 
+            only (list)      Properties to load (default None, i.e., all properties)
+
+            use_python_datetime (bool)  Use datetime.datetime, datetime.date and datetime.time
+                                        objects for the datetime, date and hour properties
+                                        (default False, i.e., datetime64 and int hours)
+
+            keep_qa (bool)   Include the source and uncertainty columns in the dataframe
+                             (default False, i.e., read them only when qa is accessed)
+
         PROPERTIES:
 
             alb (pandas.Series)            Alb (unitless) as float
             aod (pandas.Series)            AOD (unitless) as float
             ceilhgt (pandas.Series)        CeilHgt (m) as float
-            dataframe (pandas.DataFrame)   Raw TMY3 data
-            date (pandas.Series)           Date (MM/DD/YYYY) as datetime.date
-            datetime (pandas.Series)       Full date and time index as datetime.datetime
+            dataframe (pandas.DataFrame)   Raw TMY3 data, loaded on first access
+            date (pandas.Series)           Date (MM/DD/YYYY) as datetime64
+            datetime (pandas.Series)       Full date and time index as datetime64[ns]
             dewpoint (pandas.Series)       Dew-point (C) as float
             dhi (pandas.Series)            DHI (W/m^2) as float
             dhillum(pandas.Series)         DH illum (lx) as float
             dni (pandas.Series)            DNI (W/m^2) as float
             dnillum (pandas.Series)        DN illum (lx) as float
             drybulb (pandas.Series)        Dry-bulb (C) as float
-            ertn (pandas.Series)           ETRN (W/m^2) as float
+            etrn (pandas.Series)           ETRN (W/m^2) as float
             etr (pandas.Series)            ETR (W/m^2) as float 
+            filename (str)                 Filename of TMY3 data loaded
             ghi (pandas.Series)            GHI (W/m^2) as float
             ghillum (pandas.Series)        GH illum (lx) as float
+            hour (pandas.Series)           Time (HH:MM) as int hour of day (0-23)
             hvis (pandas.Series)           Hvis (m) as float
             lprecipdepth (pandas.Series)   Lprecip depth (mm) as float
             lprecipquantity(pandas.Series) Lprecip quantity (hr)
             opqcld (pandas.Series)         OpqCld (tenths) as float
             pressure (pandas.Series)       Pressure (mbar) as float
             pwat (pandas.Series)           Pwat (cm) as float
+            qa (pandas.DataFrame)          Source and uncertainty columns, loaded on first access
             rhum (pandas.Series)           RHum (%) as float
-            time (pandas.Series)           Time (HH:MM) as datetime.time
             totcld (pandas.Series)         TotCld (tenths) as float
-            units (dict)                   Units dictionary for float properties
+            units (mapping)                Read-only units dictionary for float properties
             wdir (pandas.Series)           Wdir (degrees) as float
             wspd (pandas.Series)           Wspd (m/s) as float
             zenlu (pandas.Series)          Zenith lum (cd/m^2) as float
         """
-        info = pandas.read_table(filename,
-            delimiter=",",
-            skiprows=0,
-            nrows=1,
-            header=None,
-            names=["station","name","state","tzoffset","latitude","longitude","elevation"])
-        for item in info.columns:
-            setattr(self,item,info[item])
-        def get_date(dt,coerce_year=coerce_year):
-            if coerce_year:
-                return datetime.datetime.strptime(dt,"%m/%d/%Y").replace(year=coerce_year).date()
+        self.filename = filename
+        if only:
+            unknown = set(only) - ATTRIBUTES.keys()
+            if unknown:
+                raise ValueError(f"unknown TMY3 properties {sorted(unknown)}")
+            columns = [column for column in KEEP_COLUMNS if column in DATETIME_COLUMNS or RENAME_MAP[column] in only]
+        else:
+            columns = KEEP_COLUMNS
+        self.coerce_year = coerce_year
+        self.use_python_datetime = use_python_datetime
+        self.keep_qa = keep_qa
+        self._columns = columns
+        self._parquet = f"{filename}.parquet"
+        source = os.stat(filename).st_mtime_ns # before opening, so that a snapshot is never tagged newer than its data
+        with _open_csv(filename) as (info,fh):
+            for (item,convert),value in zip(INFO_COLUMNS.items(),info):
+                setattr(self,item,pandas.Series([convert(value)],name=item))
+            if keep_qa:
+                self.dataframe = self._set_datetime(_read_csv(fh,columns + QA_COLUMNS if only else None))
+            elif not pyarrow or not os.path.exists(self._parquet) or _parquet_source(self._parquet) != source:
+                data = _read_csv(fh,columns)
+                if not only and pyarrow: # without pyarrow the CSV is parsed every time
+                    try:
+                        _write_parquet(data,self._parquet,source)
+                    except OSError:
+                        pass # read-only or full cache directory, the snapshot is only an optimization
+                self.dataframe = self._set_datetime(data)
             else:
-                return datetime.datetime.strptime(dt,"%m/%d/%Y").date()
-        def get_time(dt):
-            return datetime.time(hour=int(dt.split(':')[0])-1)
-        self.dataframe = pandas.read_table(filename,delimiter=",",skiprows=1,nrows=8760,header=0,
-            converters={
-                'Date (MM/DD/YYYY)' : get_date,
-                'Time (HH:MM)' : get_time,
-                'ETR (W/m^2)' : float, 
-                'ETRN (W/m^2)' : float,
-                'GHI (W/m^2)' : float, 
-                'GHI source' : float,
-                'GHI uncert (%)' : float, 
-                'DNI (W/m^2)' : float,
-                'DNI source' : str,
-                'DNI uncert (%)' : float,
-                'DHI (W/m^2)' : float,
-                'DHI source' : str,
-                'DHI uncert (%)' : float,
-                'GH illum (lx)' : float,
-                'GH illum source' : str,
-                'Global illum uncert (%)' : float,
-                'DN illum (lx)' : float,
-                'DN illum source' : str,
-                'DN illum uncert (%)' : float,
-                'DH illum (lx)' : float,
-                'DH illum source' : str,
-                'DH illum uncert (%)' : float,
-                'Zenith lum (cd/m^2)' : float,
-                'Zenith lum source' : str,
-                'Zenith lum uncert (%)' : float,
-                'TotCld (tenths)' : float,
-                'TotCld source' : str,
-                'TotCld uncert (code)' : int,
-                'OpqCld (tenths)' : float,
-                'OpqCld source' : str,
-                'OpqCld uncert (code)' : int,
-                'Dry-bulb (C)' : float,
-                'Dry-bulb source' : str,
-                'Dry-bulb uncert (code)' : int,
-                'Dew-point (C)' : float,
-                'Dew-point source' : str,
-                'Dew-point uncert (code)' : int,
-                'RHum (%)' : float,
-                'RHum source' : str,
-                'RHum uncert (code)' : int,
-                'Pressure (mbar)' : float,
-                'Pressure source' : str,
-                'Pressure uncert (code)' : int,
-                'Wdir (degrees)' : float,
-                'Wdir source' : str,
-                'Wdir uncert (code)' : int,
-                'Wspd (m/s)' : float,
-                'Wspd source' : str,
-                'Wspd uncert (code)' : int,
-                'Hvis (m)' : float,
-                'Hvis source' : str,
-                'Hvis uncert (code)' : int,
-                'CeilHgt (m)' : float,
-                'CeilHgt source' : str,
-                'CeilHgt uncert (code)' : int,
-                'Pwat (cm)' : float,
-                'Pwat source' : str,
-                'Pwat uncert (code)' : int,
-                'AOD (unitless)' : float,
-                'AOD source' : str,
-                'AOD uncert (code)' : int,
-                'Alb (unitless)' : float,
-                'Alb source' : str,
-                'Alb uncert (code)' : int,
-                'Lprecip depth (mm)' : float,
-                'Lprecip quantity (hr)' : float,
-                'Lprecip source' : str,
-                'Lprecip uncert (code)' : int,
-                'PresWth (METAR code)' : int,
-                'PresWth source' : str,
-                'PresWth uncert (code)': int,
-            })
-        self.dataframe.index.name = "Hour"
-        self.dataframe.insert(0,'DateTime',list(map(lambda x,y: datetime.datetime(x.year,x.month,x.day,y.hour),*(self.dataframe['Date (MM/DD/YYYY)'],self.dataframe['Time (HH:MM)']))))
-        for column, name in {
-            'DateTime' : 'datetime',
-            'Date (MM/DD/YYYY)' : "date",
-            'Time (HH:MM)' : "hour",
-            'ETR (W/m^2)' : "etr", 
-            'ETRN (W/m^2)' : "etrn",
-            'GHI (W/m^2)' : "ghi", 
-            'DNI (W/m^2)' : "dni",
-            'DHI (W/m^2)' : "dhi",
-            'GH illum (lx)' : "ghillum",
-            'DN illum (lx)' : "dnillum",
-            'DH illum (lx)' : "dhillum",
-            'Zenith lum (cd/m^2)' : "zenlu ",
-            'TotCld (tenths)' : "totcld",
-            'OpqCld (tenths)' : "opqcld",
-            'Dry-bulb (C)' : "drybulb",
-            'Dew-point (C)' : "dewpoint",
-            'RHum (%)' : "rhum",
-            'Pressure (mbar)' : "pressure",
-            'Wdir (degrees)' : "wdir",
-            'Wspd (m/s)' : "wspd",
-            'Hvis (m)' : "hvis",
-            'CeilHgt (m)' : "ceilhgt",
-            'Pwat (cm)' : "pwat",
-            'AOD (unitless)' : "aod",
-            'Alb (unitless)' : "alb",
-            'Lprecip depth (mm)' : "lprecipdepth",
-            'Lprecip quantity (hr)' : "lprecipquantity",
-        }.items():
-            setattr(self,name,self.dataframe[column])
-        self.units = {
-            'etr' : "W/m^2", 
-            'etrn' : "W/m^2",
-            'ghi' : "W/m^2", 
-            'dni' : "W/m^2",
-            'dhi' : "W/m^2",
-            'ghillum' : "lx",
-            'ghillum' : "lx",
-            'dnillum' : "lx",
-            'zenlu' : "cd/m^2 ",
-            'totcld' : "0.1unit",
-            'opqcld' : "0.1unit",
-            'drybulb' : "degC",
-            'dewpoint' : "degC",
-            'rhum' : "%",
-            'pressure' : "mbar",
-            'wdir' : "deg",
-            'wspd' : "m/s",
-            'hvis' : "m",
-            'ceilhgt' : "m",
-            'pwat' : "cm",
-            'aod' : "unit",
-            'alb' : "unit",
-            'lprecipdepth' : "mm",
-            'lprecipquantity' : "hr",
-
-        }
-
-import unittest
+                # the dataframe and properties are read from the parquet file on first access
+                self._snapshot = source
+
+    def __getattr__(self,name):
+        """Load the dataframe or a single property from the parquet file on first access"""
+        state = self.__dict__
+        column = ATTRIBUTES.get(name)
+        if "_columns" not in state or ( name != "dataframe" and column != 'DateTime' and column not in state["_columns"] ):
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+        if name == "dataframe":
+            value = self._set_datetime(self._read_parquet(state["_columns"]))
+        elif "dataframe" in state:
+            value = state["dataframe"][column]
+        elif column == 'DateTime' or column in DATETIME_COLUMNS:
+            value = self._set_datetime(self._read_parquet(DATETIME_COLUMNS))[column]
+        else:
+            value = self._read_parquet([column])[column]
+        state[name] = value
+        return value
+
+    def _read_parquet(self,columns):
+        # never mix columns from snapshots of different CSV files, but a rebuild from the same CSV file is fine
+        with open(self._parquet,"rb") as f: # the source check and the read see the same file even if it is replaced
+            if _parquet_source(f) != self._snapshot:
+                _load_tmy3.cache_clear() # so that get_tmy3() makes a new object instead of returning this one
+                raise OSError(errno.ESTALE,"TMY3 data changed since it was loaded, use get_tmy3() again",self.filename)
+            f.seek(0)
+            return pandas.read_parquet(f,columns=columns)
+
+    def _set_datetime(self,data):
+        date = data['Date (MM/DD/YYYY)']
+        if self.coerce_year:
+            date = pandas.to_datetime(dict(year=self.coerce_year,month=date.dt.month,day=date.dt.day)).astype('datetime64[ns]')
+            data['Date (MM/DD/YYYY)'] = date
+        data.insert(0,'DateTime',date + pandas.to_timedelta(data['Time (HH:MM)'],unit='h'))
+        if self.use_python_datetime:
+            # numpy converts whole-hour and whole-day datetime64 values to datetime objects in C
+            data['DateTime'] = pandas.Series(data['DateTime'].to_numpy().astype('datetime64[h]').astype(object),index=data.index,dtype=object)
+            data['Date (MM/DD/YYYY)'] = pandas.Series(date.to_numpy().astype('datetime64[D]').astype(object),index=data.index,dtype=object)
+            data['Time (HH:MM)'] = pandas.Series(HOURS[data['Time (HH:MM)'].to_numpy()],index=data.index,dtype=object)
+        return data
+
+    @functools.cached_property
+    def qa(self):
+        """Source and uncertainty columns, read from the TMY3 file on first access unless keep_qa is set"""
+        if self.keep_qa:
+            return self.dataframe[QA_COLUMNS]
+        with _open_csv(self.filename) as (info,fh):
+            return _read_csv(fh,QA_COLUMNS)
+
+import unittest, unittest.mock
 class _unittest(unittest.TestCase):
 
     def test_1_get_index(self):
         self.assertEqual(get_index()[0],"AK-Adak_Nas.tmy3")
+        get_index().clear()
+        self.assertEqual(get_index()[0],"AK-Adak_Nas.tmy3")
 
     def test_2_get_data(self):
         station = get_index()[0]
         tmy3 = get_tmy3(station,coerce_year=2020)
-        self.assertEqual(tmy3.drybulb[0],0.2)
+        self.assertEqual(tmy3.drybulb[0],numpy.float32(0.2))
+        self.assertEqual(tmy3.units['drybulb'],"degC")
+        self.assertEqual(tmy3.datetime.dtype,"datetime64[ns]")
+
+    def test_3_get_tmy3_cached(self):
+        station = get_index()[0]
+        self.assertIs(get_tmy3(station,coerce_year=2020),get_tmy3(station,coerce_year=2020))
+
+    def test_4_units_keys_match_attrs(self):
+        tmy3 = get_tmy3(get_index()[0])
+        self.assertEqual(set(tmy3.units),set(ATTRIBUTES)-{"datetime","date","hour"})
+        for name in tmy3.units:
+            self.assertEqual(len(getattr(tmy3,name)),8760)
+
+    def test_5_pickle(self):
+        tmy3 = pickle.loads(pickle.dumps(get_tmy3(get_index()[0],coerce_year=2020)))
+        self.assertEqual(tmy3.drybulb[0],numpy.float32(0.2))
         self.assertEqual(tmy3.units['drybulb'],"degC")
 
+    def test_6_get_tmy3_many(self):
+        station = get_index()[0]
+        tmy3 = get_tmy3_many([station,station],coerce_year=2020,max_workers=2)
+        self.assertEqual([x.drybulb[0] for x in tmy3],[numpy.float32(0.2)]*2)
+
+    def test_7_get_tmy3_reloads_changed_file(self):
+        station = get_index()[0]
+        tmy3 = get_tmy3(station)
+        os.utime(get_data(station,cache_filename_only=True))
+        self.assertIsNot(get_tmy3(station),tmy3)
+
+    def test_8_source_categories_sorted(self):
+        qa = get_tmy3(get_index()[0]).qa
+        for column in SOURCE_COLUMNS:
+            self.assertEqual(list(qa[column].cat.categories),sorted(qa[column].cat.categories))
+
+    def test_9_snapshot_rebuild(self):
+        station = get_index()[0]
+        filename = get_data(station,cache_filename_only=True)
+        TMY3(filename) # make sure the parquet snapshot is current
+        _load_tmy3.cache_clear()
+        tmy3 = get_tmy3(station)
+        self.assertNotIn("dataframe",tmy3.__dict__)
+        data = pandas.read_parquet(f"{filename}.parquet")
+        source = os.stat(filename).st_mtime_ns
+        _write_parquet(data,f"{filename}.parquet",source) # rebuilt from the same CSV file
+        self.assertEqual(tmy3.drybulb[0],numpy.float32(0.2))
+        _write_parquet(data,f"{filename}.parquet",source+1) # rebuilt from another CSV file
+        with self.assertRaises(OSError) as error:
+            tmy3.ghi
+        self.assertEqual(error.exception.errno,errno.ESTALE)
+        retry = get_tmy3(station)
+        self.assertIsNot(retry,tmy3)
+        self.assertEqual(len(retry.ghi),8760)
+
+    def test_10_unwritable_snapshot(self):
+        filename = get_data(get_index()[0],cache_filename_only=True)
+        os.utime(filename) # make the snapshot stale
+        with unittest.mock.patch("tempfile.mkstemp",side_effect=PermissionError(errno.EACCES,"Permission denied")):
+            tmy3 = TMY3(filename)
+        self.assertEqual(tmy3.drybulb[0],numpy.float32(0.2))
+
+    def test_11_damaged_index_pickle(self):
+        pickle_file = f"{get_data(config['index_name'],cache_filename_only=True)}.pkl"
+        get_index()
+        with open(pickle_file,"wb") as f:
+            f.write(b"\x80") # truncated pickle
+        _get_index.cache_clear()
+        self.assertEqual(get_index()[0],"AK-Adak_Nas.tmy3")
+        with open(pickle_file,"rb") as f:
+            self.assertEqual(pickle.load(f)[0],"AK-Adak_Nas.tmy3")
+
+    def _revalidate(self,response,etag=None,offline="0"):
+        """Run get_data() on a cached file in an empty cache directory against a stubbed server response
+
+        Returns the stubbed get() and the contents of the files left in the cache directory.
+        """
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        cache_file = f"{tmp_dir.name}/test.tmy3"
+        with open(cache_file,"wt") as f:
+            f.write("old")
+        if etag:
+            with open(f"{cache_file}.etag","wt") as f:
+                f.write(etag)
+        response.__enter__.return_value = response
+        with unittest.mock.patch.dict(globals(),cache_dir=tmp_dir.name), \
+                unittest.mock.patch.dict(os.environ,GLD_WEATHER_OFFLINE=offline), \
+                unittest.mock.patch.object(_SESSION,"get",return_value=response) as get:
+            get_data("test.tmy3")
+        files = {}
+        for name in os.listdir(tmp_dir.name):
+            with open(f"{tmp_dir.name}/{name}","rt") as f:
+                files[name] = f.read()
+        return get, files
+
+    def test_12_revalidate_not_modified(self):
+        get, files = self._revalidate(unittest.mock.MagicMock(status_code=304),etag='"a"')
+        self.assertEqual(get.call_args.kwargs["headers"]["If-None-Match"],'"a"')
+        self.assertEqual(files,{"test.tmy3":"old","test.tmy3.etag":'"a"'})
+
+    def test_13_revalidate_modified(self):
+        response = unittest.mock.MagicMock(status_code=200,headers={"ETag":'"b"'})
+        response.iter_content.return_value = [b"ne",b"w"]
+        get, files = self._revalidate(response,etag='"a"')
+        self.assertEqual(files,{"test.tmy3":"new","test.tmy3.etag":'"b"'})
+
+    def test_14_revalidate_without_etag(self):
+        response = unittest.mock.MagicMock(status_code=200,headers={})
+        response.iter_content.return_value = [b"new"]
+        get, files = self._revalidate(response,etag='"a"')
+        self.assertEqual(files,{"test.tmy3":"new"})
+
+    def test_15_revalidate_broken_body(self):
+        def body(size):
+            yield b"ne"
+            raise requests.exceptions.ChunkedEncodingError("connection broken")
+        response = unittest.mock.MagicMock(status_code=200,headers={"ETag":'"b"'})
+        response.iter_content.side_effect = body
+        get, files = self._revalidate(response,etag='"a"')
+        self.assertEqual(files,{"test.tmy3":"old","test.tmy3.etag":'"a"'})
+
+    def test_16_revalidate_offline(self):
+        get, files = self._revalidate(unittest.mock.MagicMock(status_code=200),offline="1")
+        get.assert_not_called()
+        self.assertEqual(files,{"test.tmy3":"old"})
+
+    def test_17_keep_qa(self):
+        station = get_index()[0]
+        tmy3 = get_tmy3(station,keep_qa=True)
+        self.assertEqual(len(tmy3.dataframe.columns),72)
+        self.assertEqual(set(tmy3.dataframe.columns),{'DateTime'} | DTYPES.keys())
+        pandas.testing.assert_frame_equal(tmy3.qa,get_tmy3(station).qa)
+
+    def test_18_use_python_datetime(self):
+        filename = get_data(get_index()[0],cache_filename_only=True)
+        os.utime(filename) # make the snapshot stale, so that the first object is parsed from the CSV file
+        for lazy in [False,True]:
+            tmy3 = TMY3(filename,coerce_year=2020,use_python_datetime=True)
+            self.assertEqual("dataframe" not in tmy3.__dict__,lazy)
+            expected = TMY3(filename,coerce_year=2020)
+            self.assertEqual(set(map(type,tmy3.datetime)),{datetime.datetime})
+            self.assertEqual(set(map(type,tmy3.date)),{datetime.date})
+            self.assertEqual(set(map(type,tmy3.hour)),{datetime.time})
+            self.assertEqual(list(tmy3.datetime),[x.to_pydatetime() for x in expected.datetime])
+            self.assertEqual(list(tmy3.date),[x.date() for x in expected.date])
+            self.assertEqual(list(tmy3.hour),[datetime.time(hour=x) for x in expected.hour])
+
+    def test_19_only(self):
+        filename = get_data(get_index()[0],cache_filename_only=True)
+        os.utime(filename) # make the snapshot stale, so that the first object is parsed from the CSV file
+        for lazy in [False,True]:
+            tmy3 = TMY3(filename,only=['drybulb','ghi'])
+            self.assertEqual("dataframe" not in tmy3.__dict__,lazy)
+            self.assertEqual(set(tmy3.dataframe.columns),{'DateTime','Date (MM/DD/YYYY)','Time (HH:MM)','Dry-bulb (C)','GHI (W/m^2)'})
+            self.assertEqual(tmy3.drybulb[0],numpy.float32(0.2))
+            with self.assertRaises(AttributeError):
+                tmy3.dni
+            TMY3(filename) # rebuild the snapshot for the lazy pass
+        with self.assertRaises(ValueError):
+            TMY3(filename,only=['drybulb','nosuchproperty'])
+
 if __name__ == '__main__':
     unittest.main()
 